@@ -1,8 +1,13 @@
 
-import os.path
-from os import listdir
+import os
+import stat
+import sys
 import re
-from collections import OrderedDict, deque, Sequence
+import mmap
+from bisect import bisect_left
+from collections import defaultdict
+from collections.abc import Sequence
+from functools import lru_cache
 import logging
 import warnings
 
@@ -11,7 +16,17 @@ try:
 except ImportError:
     from itertools import izip_longest as zip_longest
 
-default_tokenizer = re.compile(r'\S+\s*')
+# google-re2 compiles simple patterns like the marker-line pattern to a
+# DFA, which scans large buffers much faster than the backtracking re
+# engine; it is optional and re is used when it isn't installed
+try:
+    import re2 as _re2
+except ImportError:
+    _re2 = None
+
+# tokens carry no surrounding whitespace, so match positions delimit
+# the token exactly and no per-token rstrip is needed
+default_tokenizer = re.compile(r'\S+')
 
 class ToolboxError(Exception): pass
 class ToolboxInitError(ToolboxError): pass
@@ -25,11 +40,16 @@ warnings.formatwarning = custom_formatwarning
 
 def find_project_file(path):
     proj_path = None
-    if os.path.isfile(path):
-        if path.lower().endswith('.prj'):
+    try:
+        st = os.stat(path)
+    except OSError:
+        st = None
+    if st is not None and stat.S_ISREG(st.st_mode):
+        if path[-4:].lower() == '.prj':
             proj_path = path
-    elif os.path.isdir(path):
-        fns = [fn for fn in listdir(path) if fn.lower().endswith('.prj')]
+    elif st is not None and stat.S_ISDIR(st.st_mode):
+        with os.scandir(path) as entries:
+            fns = [e.name for e in entries if e.name[-4:].lower() == '.prj']
         if len(fns) == 1:
             proj_path = fns[0]
     if proj_path is None:
@@ -39,7 +59,10 @@ def find_project_file(path):
     return proj_path
 
 
-toolbox_line_re = re.compile(r'(?P<mkr>\\[^\s]+)( (?P<val>.*\n?))?$')
+# matches marker lines; read_toolbox_file() now scans with string
+# operations, but the pattern remains available for other uses
+_toolbox_line_pattern = r'(?m)^(?P<mkr>\\[^\s]+)(?: (?P<val>.*))?$'
+toolbox_line_re = (_re2 or re).compile(_toolbox_line_pattern)
 
 # inspired by the NLTK's implementation:
 #   http://www.nltk.org/_modules/nltk/toolbox.html
@@ -48,7 +71,9 @@ def read_toolbox_file(f, strip=True):
     Parse a Toolbox file and yield pairs of (marker, value). By default,
     no interpretation or normalization of the data is done besides
     stripping the trailing whitespace of each value (set the `strip`
-    parameter to False to leave whitespace on).
+    parameter to False to leave whitespace on). The file is read into
+    memory and scanned for markers in a single pass, so values are
+    simply slices of the buffer between marker positions.
 
     Args:
         f: An open file-like object.
@@ -56,28 +81,101 @@ def read_toolbox_file(f, strip=True):
     Yields:
         Pairs of (marker, value)
     """
-    def make_val(val_lines, strip):
-        if val_lines == [None]:
+    yield from _scan_buffer(f.read(), strip)
+
+
+def read_toolbox_path(path, strip=True):
+    """
+    Like read_toolbox_file(), but take a path instead of an open file
+    and read the file through a memory map, so values are zero-copy
+    slices of the mapping that are decoded (as UTF-8) only when
+    yielded. This keeps memory flat for large project files.
+
+    Args:
+        path: The path of a Toolbox file.
+        strip: If True, strip trailing whitespace from each value.
+    Yields:
+        Pairs of (marker, value)
+    """
+    with open(path, 'rb') as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return  # empty files cannot be mapped (and have no pairs)
+        try:
+            yield from _scan_buffer(mm, strip)
+        finally:
+            mm.close()
+
+
+def _scan_buffer(buf, strip):
+    # scan a str or bytes-like buffer (e.g. an mmap) for marker lines;
+    # bytes are decoded as UTF-8 before marker validation (whitespace
+    # such as U+3000 is multi-byte) and when values are yielded
+    if isinstance(buf, str):
+        bslash, nl_bslash, nl, space = '\\', '\n\\', '\n', ' '
+        encoding = None
+    else:
+        bslash, nl_bslash, nl, space = b'\\', b'\n\\', b'\n', b' '
+        encoding = 'utf-8'
+    def make_val(start, end, nullable):
+        # a marker with no space after it has no value on its own line;
+        # if nothing follows before the next marker, the value is None
+        if nullable and start >= end:
             return None
-        val = ''.join([s or '' for s in val_lines])  # first s might be None
-        if strip:
-            val = val.rstrip()
-        return val
+        val = buf[start:end]
+        if encoding is not None:
+            val = val.decode(encoding)
+        return val.rstrip() if strip else val
+    size = len(buf)
     mkr = None
-    val_lines = []
-    for line in f:
-        mkr_match = toolbox_line_re.match(line)
-        if mkr_match is not None:
+    val_start = 0
+    nullable = False
+    if buf[:1] == bslash:
+        pos = 0
+    else:
+        i = buf.find(nl_bslash)
+        pos = i + 1 if i >= 0 else -1
+    while pos >= 0:
+        line_end = buf.find(nl, pos)
+        if line_end < 0:
+            line_end = size
+        sp = buf.find(space, pos, line_end)
+        cand = buf[pos:(line_end if sp < 0 else sp)]
+        if encoding is not None:
+            cand = cand.decode(encoding)
+        # a marker is a backslash followed by one or more non-whitespace
+        # characters; anything else is part of the previous value
+        if len(cand) > 1 and not any(map(str.isspace, cand)):
             # first yield the current pair
             if mkr is not None:
-                yield (mkr, make_val(val_lines, strip))
-            mkr = mkr_match.group('mkr')
-            val_lines = [mkr_match.group('val')]
-        else:
-            val_lines.append(line)
-    # when we reach the end of the file, yield the final pair
+                yield (mkr, make_val(val_start, pos, nullable))
+            # markers repeat throughout a file; interning them makes
+            # later dict and set lookups hit the pointer-equality fast
+            # path and avoids storing duplicate strings
+            mkr = sys.intern(cand)
+            if sp < 0:
+                val_start, nullable = line_end + 1, True
+            else:
+                val_start, nullable = sp + 1, False
+        i = buf.find(nl_bslash, line_end)
+        pos = i + 1 if i >= 0 else -1
+    # when we reach the end of the buffer, yield the final pair
     if mkr is not None:
-        yield (mkr, make_val(val_lines, strip))
+        yield (mkr, make_val(val_start, size, nullable))
+
+
+@lru_cache(maxsize=128)
+def _split_keys(keys):
+    # '\\mkr' becomes '\\+mkr' and '\\-mkr'; this is a fixed literal
+    # transformation, so plain slicing suffices; key_map goes the other
+    # way, so block markers normalize with a lookup instead of a new
+    # string per event
+    start_keys = frozenset('\\+' + k[1:] for k in keys)
+    end_keys = frozenset('\\-' + k[1:] for k in keys)
+    key_map = {'\\+' + k[1:]: k for k in keys}
+    key_map.update(('\\-' + k[1:], k) for k in keys)
+    return start_keys, end_keys, keys | start_keys | end_keys, key_map
 
 
 def iterparse(pairs, keys):
@@ -101,25 +199,24 @@ def iterparse(pairs, keys):
     Yields:
         Pairs of (event, result).
     """
-    start_keys = set(re.sub(r'\\(.*)', r'\+\1', k) for k in keys)
-    end_keys = set(re.sub(r'\\(.*)', r'\-\1', k) for k in keys)
-    all_keys = set(keys).union(start_keys, end_keys)
+    keys = frozenset(keys)
+    start_keys, end_keys, all_keys, key_map = _split_keys(keys)
     data = []
     for mkr, val in pairs:
         if mkr in all_keys:
-            if len(data) > 0:
+            if data:
                 yield ('data', data)
                 data = []
             if mkr in keys:
                 yield ('key', (mkr, val))
             elif mkr in start_keys:
-                yield ('start', ('\\{}'.format(mkr[2:]), val))
+                yield ('start', (key_map[mkr], val))
             elif mkr in end_keys:
-                yield ('end', ('\\{}'.format(mkr[2:]), val))
+                yield ('end', (key_map[mkr], val))
         else:
             data.append((mkr, val))
     # don't forget to yield the last one
-    if len(data) > 0:
+    if data:
         yield ('data', data)
 
 
@@ -236,29 +333,42 @@ def normalize_record(pairs, aligned_fields, strip=True):
     \g dog =NOM one  -CLF.ANIMAL bark -IPFV
     \f One dog barks.
     """
-    field_data = OrderedDict()
-    # gather lines with the same marker, and keep track of the longest
-    # aligned fields at each position
-    maxlens = {}
+    field_data = defaultdict(list)
+    # gather lines with the same marker; dicts preserve insertion order,
+    # so markers come back out in the order they were first seen
     for mkr, val in pairs:
-        if mkr not in field_data:
-            field_data[mkr] = []
+        data = field_data[mkr]
         if val is None:
             continue
-        field_data[mkr].append(val)
-        i = len(field_data[mkr]) - 1
-        # this string length counts unicode combining characters, so
-        # the lengths may appear off when printed
-        if mkr in aligned_fields and len(val) > maxlens.get(i, -1):
-            maxlens[i] = len(val)
+        data.append(val)
+    # find the longest aligned field at each position by transposing the
+    # aligned rows and taking the max of each column; note that these
+    # string lengths count unicode combining characters, so the lengths
+    # may appear off when printed
+    aligned_rows = [
+        vals for mkr, vals in field_data.items() if mkr in aligned_fields
+    ]
+    maxlens = [
+        max(map(len, col)) for col in zip_longest(*aligned_rows, fillvalue='')
+    ]
     # join and normalize spacing (use longest length for each position)
     mkrs = list(field_data.keys())
     for mkr in mkrs:
         data = field_data[mkr]
-        if data == []:
+        if not data:
             joined = None
         elif mkr in aligned_fields:
-            joined = ' '.join(s.ljust(maxlens[i]) for i, s in enumerate(data))
+            # build the padding directly instead of ljust-ing each value,
+            # so each value's characters are copied only once, by the
+            # final join
+            parts = []
+            last = len(data) - 1
+            for i, s in enumerate(data):
+                parts.append(s)
+                pad = maxlens[i] - len(s) + (1 if i != last else 0)
+                if pad > 0:
+                    parts.append(' ' * pad)
+            joined = ''.join(parts)
         else:
             joined = ' '.join(data)
         if strip and joined is not None:
@@ -282,19 +392,21 @@ def align_fields(pairs, alignments=None, tokenizers=None, errors='strict'):
             alignment target of None.
         tokenizers: A dictionary of {marker: regex}, where the compiled
             regular expression `regex` is used to find sub-parts of the
-            original value of the field. If `tokenizers` is None or a
+            original value of the field. Matches should not include
+            surrounding whitespace, as the match positions are used to
+            detect column boundaries. If `tokenizers` is None or a
             tokenizer regex is not given for a marker, and the marker is
             the source or target of an alignment, the values will be
             split by whitespace.
         errors: If 'strict', errors during alignment will be raised.
             Otherwise they will be ignored.
 
-    Returns:
-        A list of alignment pairs. Each alignment pair is a structure
-        (marker, [(target_token, [source_tokens])]). That is, for each
-        target token, a list of source tokens is aligned to it. For
+    Yields:
+        Alignment pairs. Each alignment pair is a structure
+        (marker, [(target_token, (source_tokens,))]). That is, for each
+        target token, a tuple of source tokens is aligned to it. For
         unaligned lines, the target token is None and the source tokens
-        has the original line as the only list item. Lines that are a
+        has the original line as the only item. Lines that are a
         target but not source of any alignment have their own
         untokenized line as the target token. If the value of a line is
         None (e.g. there was a marker but no content), then both the
@@ -310,43 +422,51 @@ def align_fields(pairs, alignments=None, tokenizers=None, errors='strict'):
     ...     ('\\f', 'One dog barks.'),
     ...     ('\\x', None)
     ... ]
-    >>> align_fields(data, alignments={'\\m': '\\t', '\\g': '\\m'})
+    >>> list(align_fields(data, alignments={'\\m': '\\t', '\\g': '\\m'}))
     [('\\t', [('inu=ga   ippiki           hoeru     ',
-               ['inu=ga', 'ippiki', 'hoeru'])]),
-     ('\\m', [('inu=ga', ['inu', '=ga']),
-              ('ippiki', ['ichi', '-hiki']),
-              ('hoeru', ['hoe', '-ru'])]),
-     ('\\g', [('inu', ['dog']),
-              ('=ga', ['=NOM']),
-              ('ichi', ['one']),
-              ('-hiki' ['-CLF.ANIMAL']),
-              ('hoe', ['bark']),
-              ('-ru', ['-IPFV'])]),
-     ('\\f', [(None, ['One dog barks.'])]),
+               ('inu=ga', 'ippiki', 'hoeru'))]),
+     ('\\m', [('inu=ga', ('inu', '=ga')),
+              ('ippiki', ('ichi', '-hiki')),
+              ('hoeru', ('hoe', '-ru'))]),
+     ('\\g', [('inu', ('dog',)),
+              ('=ga', ('=NOM',)),
+              ('ichi', ('one',)),
+              ('-hiki', ('-CLF.ANIMAL',)),
+              ('hoe', ('bark',)),
+              ('-ru', ('-IPFV',))]),
+     ('\\f', [(None, ('One dog barks.',))]),
      ('\\x', [(None, None)])
     ]
     """
-    aligned_fields = set(alignments.keys()).union(alignments.values())
-    alignments = dict(alignments or [])
-    tokenizers = dict(tokenizers or [])
+    # intern the alignment markers so comparisons against markers from
+    # read_toolbox_file() shortcut on identity
+    if alignments:
+        alignments = {sys.intern(k): sys.intern(v)
+                      for k, v in alignments.items()}
+    else:
+        alignments = {}
+    aligned_fields = set(alignments)
+    aligned_fields.update(alignments.values())
+    tokenizers = dict(tokenizers) if tokenizers else {}
     prev = {}  # previous tokenization matches used for alignment
-    aligned_pairs = []
     for mkr, val in pairs:
-        tokenizer = tokenizers.get(mkr, default_tokenizer)
         # empty content
         if val is None:
-            aligned_pairs.append((mkr, [(None, None)]))
+            yield (mkr, [(None, None)])
         # unaligned fields; don't do any tokenization
         elif mkr not in aligned_fields:
-            aligned_pairs.append((mkr, [(None, [val])]))
+            yield (mkr, [(None, (val,))])
         else:
-            toks = list(tokenizer.finditer(val))
+            # cache the default for markers with no custom tokenizer so
+            # repeated markers resolve with a single dict hit
+            tokenizer = tokenizers.get(mkr)
+            if tokenizer is None:
+                tokenizer = tokenizers[mkr] = default_tokenizer
+            toks = _tokenize(val, tokenizer)
             prev[mkr] = toks
             # target, but not source, of alignments; just tokenize
             if mkr not in alignments:
-                aligned_pairs.append(
-                    (mkr, [(val, [t.group(0).rstrip() for t in toks])])
-                )
+                yield (mkr, [(val, tuple(t[2] for t in toks))])
             # source of an alignment; tokenize and align
             else:
                 tgt_toks = prev.get(alignments[mkr])
@@ -359,74 +479,73 @@ def align_fields(pairs, alignments=None, tokenizers=None, errors='strict'):
                 aligned = _align_tokens(
                     toks, tgt_toks, errors=errors
                 )
-                aligned_pairs.append((mkr, aligned))
-    return aligned_pairs
+                yield (mkr, aligned)
+
+
+def _tokenize(val, tokenizer):
+    # extract (start, end, token) triples up front so the alignment
+    # passes never revisit the match objects
+    return [(m.start(), m.end(), m.group(0)) for m in tokenizer.finditer(val)]
 
 
 def _align_tokens(src, tgt, errors='strict'):
-    # make a deque so we can efficiently pop from the front; also this
-    # makes a copy of src so we don't affect the original
-    _src = deque(src)
-    _tgt = deque(tgt)
-    #last_tgt_idx = len(_tgt) - 1
-    #last_end = -1  # the end pos of the last source token
-    aligned = []
-    while _tgt:
-        t = _tgt.popleft()
-        next_t = _tgt[0] if _tgt else None  # None indicates end of deque
+    _src, _tgt = src, tgt
+    while True:
         try:
-            grp = _collect_aligned_tokens(
-                _src, t, next_t, errors=errors
-            )
-        except ToolboxAlignmentError as e:
+            return _merge_aligned_tokens(_src, _tgt, errors=errors)
+        except ToolboxAlignmentError:
             if errors == 'reanalyze':
                 _src, _tgt = _reanalyze_tokens(src, tgt)
-                aligned = []
                 errors = 'reanalyze_1'  # change this to avoid a cycle
-                continue
             else:
                 raise
-        aligned.append((t.group(0).rstrip(), grp))
-    return aligned
 
 
-def _collect_aligned_tokens(src, t, next_t, errors='strict'):
-    grp = []
-    while src:
-        s = src[0]  # don't pop just yet
-        s_tok = s.group(0).rstrip()
-
-        if next_t is not None:
-
-            # basic case; reached next column
-            if s.start() >= next_t.start():
-                break
-
-            # exceptional case; overlapping columns
-            s_end = s.start() + len(s_tok)
-            if s_end >= next_t.start():
-                msg = 'Possible misalignment at position {} ({}).'.format(
-                    next_t.start(), s_tok
-                )
-                # recover in some way, but still warn the user
-                warnings.warn(msg, ToolboxWarning)
-                if errors == 'ratio':
-                    ratio = float(s_end - next_t.start()) / len(s_tok)
-                    if ratio >= 0.5:
-                        break
-                else:  # errors == 'strict' or otherwise
-                    raise ToolboxAlignmentError(msg)
-
-        # we're good to go. pop the token and continue
-        src.popleft()  # no need to store it again
-        grp.append(s_tok)
-    return grp
+def _merge_aligned_tokens(src, tgt, errors='strict'):
+    # parallel lists of start positions and tokens make the merge a
+    # single two-pointer walk over the source tokens
+    src_starts = [s[0] for s in src]
+    src_toks = [s[2] for s in src]
+    tgt = list(tgt)
+    last_tgt_idx = len(tgt) - 1
+    aligned = []
+    i = 0
+    for k, t in enumerate(tgt):
+        if k == last_tgt_idx:
+            # last column; collect all remaining source tokens
+            j = len(src_toks)
+        else:
+            # basic case; collect source tokens up to the next column
+            next_start = tgt[k + 1][0]
+            j = bisect_left(src_starts, next_start, lo=i)
+            # exceptional case; only the last token collected can
+            # overlap the next column
+            if j > i:
+                s_tok = src_toks[j - 1]
+                s_end = src[j - 1][1]
+                if s_end >= next_start:
+                    msg = 'Possible misalignment at position {} ({}).'.format(
+                        next_start, s_tok
+                    )
+                    # recover in some way, but still warn the user
+                    warnings.warn(msg, ToolboxWarning)
+                    if errors == 'ratio':
+                        ratio = float(s_end - next_start) / len(s_tok)
+                        if ratio >= 0.5:
+                            j -= 1  # it mostly belongs to the next column
+                    else:  # errors == 'strict' or otherwise
+                        raise ToolboxAlignmentError(msg)
+        # token groups are never mutated downstream, so emit tuples,
+        # which are cheaper to build and hold
+        aligned.append((t[2], tuple(src_toks[i:j])))
+        i = j
+    return aligned
 
 
 def _reanalyze_tokens(src, tgt):
     # get joined strings
-    src = ' '.join(x.group(0) for x in src)
-    tgt = ' '.join(x.group(0) for x in tgt)
+    src = ' '.join(x[2] for x in src)
+    tgt = ' '.join(x[2] for x in tgt)
     # normalize spacing
     src = re.sub(r'\s+', ' ', src.strip())
     tgt = re.sub(r'\s+', ' ', tgt.strip())
@@ -455,9 +574,9 @@ def _reanalyze_tokens(src, tgt):
             _src = list(map(lambda xs: ' '.join(xs), _src))
             src, tgt = zip(*map(lambda st: _ljust_pair(*st), zip(_src, tgt)))
             break
-    # finally return re matches with the default tokenizer
-    src = deque(default_tokenizer.finditer(' '.join(src)))
-    tgt = deque(default_tokenizer.finditer(' '.join(tgt)))
+    # finally retokenize with the default tokenizer
+    src = _tokenize(' '.join(src), default_tokenizer)
+    tgt = _tokenize(' '.join(tgt), default_tokenizer)
     return src, tgt
 
 